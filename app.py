@@ -2,6 +2,7 @@ import os
 import sys
 import sqlite3
 import json
+import numbers
 import random
 import datetime
 import datetime
@@ -24,6 +25,17 @@ def serve_assets(path):
 # 1. Use absolute path (Avoid IIS file not found error)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_FILE = os.path.join(BASE_DIR, 'sops.db')
+# Side database shared by all wfastcgi worker processes (caches, presence, PI health)
+SHARED_DB_FILE = os.path.join(BASE_DIR, 'shared_state.db')
+
+# Shared state TTLs (seconds)
+TAG_CACHE_TTL = 5        # How long a PI tag value is reused across workers
+TAG_LEASE_TTL = 10       # Max time one worker may hold the "I'm reading this tag" lease
+TAG_WAIT_TIMEOUT = 1.5   # Max time to wait on another worker's read before reading ourselves
+PI_STATUS_TTL = 30       # How long a PI health check result is reused
+PRESENCE_TTL = 30        # Heartbeat expiry for online users
+SHARED_DB_TIMEOUT = 1.5  # Busy timeout; a contended side DB becomes a cache miss, not a hung worker
+SHARED_PRUNE_INTERVAL = 300  # How often a worker deletes expired shared rows
 
 # --- Logging Setup for Startup Analysis ---
 import time
@@ -43,6 +55,10 @@ def lazy_load_pi():
     global PI, PI_AVAILABLE
     if PI_AVAILABLE is not None:
         return PI_AVAILABLE
+
+    # Another worker on this host already found PIconnect unusable; don't pay the import again
+    if shared_get('pi:available') is False:
+        return False
     
     t_start = time.time()
     try:
@@ -56,14 +72,219 @@ def lazy_load_pi():
         PI_AVAILABLE = False
         log_startup(f"PIconnect not found (Lazy Load). (Took {time.time() - t_start:.4f}s)")
         print("PIconnect not found. PI Server Offline.")
+        mark_pi_unavailable()
     except Exception as e:
         PI_AVAILABLE = False
         log_startup(f"PIconnect lazy init failed: {e} (Took {time.time() - t_start:.4f}s)")
         print(f"PIconnect initialization failed: {e}. PI Server Offline.")
+        mark_pi_unavailable()
     
     return PI_AVAILABLE
 
 
+# --- Shared State (Cross-Worker) ---
+# IIS runs several wfastcgi worker processes, so module globals and in-memory
+# caches are per worker. Entries here live in a small SQLite side database so
+# every worker on the host sees the same values. Each entry has an absolute
+# expiry time (epoch seconds); expired rows are treated as missing.
+@contextmanager
+def get_shared_db(timeout=None):
+    # isolation_level=None: we issue BEGIN IMMEDIATE ourselves for atomic updates
+    conn = sqlite3.connect(SHARED_DB_FILE, timeout=SHARED_DB_TIMEOUT if timeout is None else timeout,
+                           isolation_level=None)
+    try:
+        # Throwaway cache: WAL + NORMAL skips the fsync on every commit
+        conn.execute('PRAGMA synchronous=NORMAL;')
+        yield conn
+    finally:
+        conn.close()
+
+def init_shared_db():
+    # Startup may race other workers creating the tables, so allow the full wait here
+    with get_shared_db(timeout=30) as conn:
+        # WAL is persistent in the file, so set it once here rather than per connection
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS shared_state (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        # Online users per process (heartbeat presence)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS presence (
+                process_id INTEGER,
+                user_id TEXT,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (process_id, user_id)
+            )
+        ''')
+
+def shared_get(key, default=None):
+    try:
+        with get_shared_db() as conn:
+            row = conn.execute("SELECT value FROM shared_state WHERE key=? AND expires_at > ?",
+                               (key, time.time())).fetchone()
+    except Exception as e:
+        print(f"Shared state read failed ({key}): {e}")
+        return default
+    return json.loads(row[0]) if row else default
+
+def shared_get_many(keys):
+    """Read several live entries over one connection. Returns {key: value} for keys that exist."""
+    if not keys:
+        return {}
+    try:
+        with get_shared_db() as conn:
+            placeholders = ','.join('?' * len(keys))
+            rows = conn.execute(f"SELECT key, value FROM shared_state WHERE key IN ({placeholders}) AND expires_at > ?",
+                                (*keys, time.time())).fetchall()
+    except Exception as e:
+        print(f"Shared state read failed ({len(keys)} keys): {e}")
+        return {}
+    return {r[0]: json.loads(r[1]) for r in rows}
+
+def shared_set(key, value, ttl):
+    try:
+        with get_shared_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(value, default=str), time.time() + ttl))
+    except Exception as e:
+        print(f"Shared state write failed ({key}): {e}")
+
+def shared_delete(key):
+    try:
+        with get_shared_db() as conn:
+            conn.execute("DELETE FROM shared_state WHERE key=?", (key,))
+    except Exception as e:
+        print(f"Shared state delete failed ({key}): {e}")
+
+def shared_claim(keys, ttl):
+    """Atomically take leases on keys. Returns the keys this worker now owns (lease value = our pid)."""
+    if not keys:
+        return []
+    try:
+        with get_shared_db() as conn:
+            now = time.time()
+            owner = json.dumps(os.getpid())
+            claimed = []
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for key in keys:
+                    row = conn.execute("SELECT 1 FROM shared_state WHERE key=? AND expires_at > ?", (key, now)).fetchone()
+                    if row:
+                        continue
+                    conn.execute("INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                                 (key, owner, now + ttl))
+                    claimed.append(key)
+                conn.execute('COMMIT')
+                return claimed
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+    except Exception as e:
+        # If the side DB is unusable, behave like a single worker and just do the work
+        print(f"Shared state claim failed: {e}")
+        return list(keys)
+
+def shared_release(key, owner=None):
+    """Drop a lease only if it is still held by owner (default: this worker)."""
+    if owner is None:
+        owner = os.getpid()
+    try:
+        with get_shared_db() as conn:
+            conn.execute("DELETE FROM shared_state WHERE key=? AND value=?", (key, json.dumps(owner)))
+    except Exception as e:
+        print(f"Shared state release failed ({key}): {e}")
+
+def shared_publish(entries, ttl, release_keys=()):
+    """Store {key: value} entries and drop this worker's leases in one transaction (one commit per request)."""
+    if not entries and not release_keys:
+        return
+    try:
+        with get_shared_db() as conn:
+            expires_at = time.time() + ttl
+            owner = json.dumps(os.getpid())
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany("INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                                 [(k, json.dumps(v, default=str), expires_at) for k, v in entries.items()])
+                conn.executemany("DELETE FROM shared_state WHERE key=? AND value=?",
+                                 [(k, owner) for k in release_keys])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+    except Exception as e:
+        print(f"Shared state publish failed ({len(entries)} entries): {e}")
+
+def pid_alive(pid):
+    """Best-effort check that the worker holding a lease still exists."""
+    if pid == os.getpid():
+        return True
+    if platform.system() == 'Windows':
+        # os.kill() would terminate the process on Windows, so ask the kernel instead
+        import ctypes
+        from ctypes import wintypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.OpenProcess.restype = wintypes.HANDLE
+        kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+        kernel32.WaitForSingleObject.argtypes = (wintypes.HANDLE, wintypes.DWORD)
+        kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+        handle = kernel32.OpenProcess(0x00100000, False, pid)  # SYNCHRONIZE
+        if not handle:
+            # ERROR_INVALID_PARAMETER: no such pid. Anything else (e.g. ERROR_ACCESS_DENIED
+            # for an app pool under another identity) means it exists, so keep its lease.
+            return ctypes.get_last_error() != 87
+        try:
+            return kernel32.WaitForSingleObject(handle, 0) == 0x102  # WAIT_TIMEOUT: still running
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+def shared_presence(process_id, user_id):
+    """Refresh a user's heartbeat and return how many users are online for the process."""
+    try:
+        with get_shared_db() as conn:
+            now = time.time()
+            conn.execute("INSERT OR REPLACE INTO presence (process_id, user_id, expires_at) VALUES (?, ?, ?)",
+                         (process_id, user_id, now + PRESENCE_TTL))
+            row = conn.execute("SELECT COUNT(DISTINCT user_id) FROM presence WHERE process_id=? AND expires_at > ?",
+                               (process_id, now)).fetchone()
+        return row[0]
+    except Exception as e:
+        print(f"Presence update failed ({process_id}): {e}")
+        return 0
+
+def mark_pi_unavailable():
+    """Tell other workers PIconnect can't load here, and drop any 'Connected' status they cached."""
+    shared_set('pi:available', False, PI_STATUS_TTL)
+    shared_delete('pi:status')
+
+_last_prune = 0
+
+def shared_prune(force=False):
+    """Delete expired rows. Readers already ignore them, so this only runs every SHARED_PRUNE_INTERVAL."""
+    global _last_prune
+    if not force and time.time() - _last_prune < SHARED_PRUNE_INTERVAL:
+        return
+    _last_prune = time.time()
+    try:
+        with get_shared_db() as conn:
+            now = time.time()
+            conn.execute("DELETE FROM shared_state WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM presence WHERE expires_at <= ?", (now,))
+    except Exception as e:
+        print(f"Shared state prune failed: {e}")
+
+
 log_startup("App initialization finished")
 
 # --- Database Setup ---
@@ -112,16 +333,6 @@ def init_db():
             )
         ''')
 
-        # Create active_users table for heartbeat
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS active_users (
-                process_id INTEGER,
-                user_id TEXT,
-                last_heartbeat TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (process_id, user_id)
-            )
-        ''')
-        
         conn.commit()
 
 # --- Routes ---
@@ -294,20 +505,9 @@ def heartbeat():
     if not process_id or not user_id:
         return jsonify({'error': 'Missing params'}), 400
         
-    with get_db() as conn:
-        c = conn.cursor()
-        
-        # Upsert heartbeat
-        c.execute("INSERT OR REPLACE INTO active_users (process_id, user_id, last_heartbeat) VALUES (?, ?, CURRENT_TIMESTAMP)", (process_id, user_id))
-        
-        # Remove old heartbeats (> 30 seconds)
-        c.execute("DELETE FROM active_users WHERE last_heartbeat < datetime('now', '-30 seconds')")
-        
-        # Count online users for this process
-        c.execute("SELECT COUNT(DISTINCT user_id) FROM active_users WHERE process_id=?", (process_id,))
-        count = c.fetchone()[0]
-        
-        conn.commit()
+    # Presence is shared by all workers; each heartbeat refreshes the user's entry
+    shared_prune()
+    count = shared_presence(process_id, user_id)
     
     return jsonify({'online_count': count})
 
@@ -315,7 +515,15 @@ def heartbeat():
 @app.route('/api/pi_status', methods=['GET'])
 def get_pi_status():
     try:
-        # Check if PIconnect is installed and available
+        # Check if PIconnect is installed and available (here or, as seen by any worker, on this host)
+        entries = shared_get_many(['pi:available', 'pi:status'])
+        if PI_AVAILABLE is False or entries.get('pi:available') is False:
+            return jsonify({'status': 'Offline', 'message': 'PI SDK Access Failed (ImportError)'})
+
+        # Reuse a recent health check from any worker instead of reconnecting every poll
+        if 'pi:status' in entries:
+            return jsonify(entries['pi:status'])
+
         if not PI_AVAILABLE:
             return jsonify({'status': 'Offline', 'message': 'PI SDK Access Failed (ImportError)'})
 
@@ -328,25 +536,38 @@ def get_pi_status():
                  server_name = server.server_name
                  # Optional: Try to read a test point if needed, but connection open is usually enough
              
-             return jsonify({'status': 'Connected', 'server': server_name})
+             status = {'status': 'Connected', 'server': server_name}
         except Exception as pi_err:
              print(f"PI Connect Error: {pi_err}")
-             return jsonify({'status': 'Offline', 'message': str(pi_err)})
+             status = {'status': 'Offline', 'message': str(pi_err)}
+
+        shared_set('pi:status', status, PI_STATUS_TTL)
+        return jsonify(status)
 
     except Exception as e:
         import traceback
         print(f"PI Status Error: {e}")
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
 
-@app.route('/api/get_tag_value')
-def get_tag_value():
-    tag_param = request.args.get('tag')
-    if not tag_param:
-        return jsonify({'error': 'No tag provided'}), 400
-    
-    tags = [t.strip() for t in tag_param.split(';') if t.strip()]
-    results = []
-    
+def normalize_pi_value(value):
+    """Convert a PI value to plain JSON so cached and fresh responses look the same."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    # numpy scalars etc. from the AF SDK bridge
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    # AF enumeration/digital states and other SDK objects
+    return str(value)
+
+def read_tags_from_pi(tags):
+    """Read tags from PI Server. Returns {tag: result}; only real PI answers are cacheable."""
+    results = {}
+    cacheable = {}
+
     # Lazy Load PI
     is_pi_ready = lazy_load_pi()
 
@@ -362,21 +583,92 @@ def get_tag_value():
                          points = server.search(tag_name)
                          if points:
                              point = points[0]
-                             value = point.current_value
-                             results.append({'tag': tag_name, 'value': value, 'timestamp': datetime.datetime.now().isoformat(), 'source': 'PI Server'})
+                             value = normalize_pi_value(point.current_value)
+                             results[tag_name] = {'tag': tag_name, 'value': value, 'timestamp': datetime.datetime.now().isoformat(), 'source': 'PI Server'}
                          else:
-                             results.append({'tag': tag_name, 'value': 'Not Found', 'timestamp': datetime.datetime.now().isoformat(), 'source': 'PI Server'})
+                             results[tag_name] = {'tag': tag_name, 'value': 'Not Found', 'timestamp': datetime.datetime.now().isoformat(), 'source': 'PI Server'}
+                         cacheable[tag_name] = results[tag_name]
                      except Exception as tag_err:
-                         results.append({'tag': tag_name, 'value': 'Error', 'timestamp': datetime.datetime.now().isoformat(), 'source': 'PI Server (Error)'})
+                         results[tag_name] = {'tag': tag_name, 'value': 'Error', 'timestamp': datetime.datetime.now().isoformat(), 'source': 'PI Server (Error)'}
         except Exception as conn_err:
              # If server connection fails entirely
              for tag_name in tags:
-                 results.append({'tag': tag_name, 'value': 'Connection Error', 'timestamp': datetime.datetime.now().isoformat(), 'source': 'PI Server (Offline)', 'error': str(conn_err)})
+                 results[tag_name] = {'tag': tag_name, 'value': 'Connection Error', 'timestamp': datetime.datetime.now().isoformat(), 'source': 'PI Server (Offline)', 'error': str(conn_err)}
     else:
         for tag_name in tags:
-             results.append({'tag': tag_name, 'value': 'Offline', 'timestamp': datetime.datetime.now().isoformat(), 'source': 'System (PI Mode: Off)'})
+             results[tag_name] = {'tag': tag_name, 'value': 'Offline', 'timestamp': datetime.datetime.now().isoformat(), 'source': 'System (PI Mode: Off)'}
+
+    return results, cacheable
+
+@app.route('/api/get_tag_value')
+def get_tag_value():
+    tag_param = request.args.get('tag')
+    if not tag_param:
+        return jsonify({'error': 'No tag provided'}), 400
+    
+    tags = [t.strip() for t in tag_param.split(';') if t.strip()]
+    results = {}
+
+    # 1. Serve whatever any worker has read recently
+    cached = shared_get_many([f'tag:{t}' for t in tags])
+    for tag_name in tags:
+        if f'tag:{tag_name}' in cached:
+            results[tag_name] = cached[f'tag:{tag_name}']
+
+    # 2. Claim the missing tags so only one worker per host reads each from PI.
+    #    Tags leased by another worker are polled briefly; if that worker is gone
+    #    (stale lease) or released without a value, we claim and read them ourselves.
+    to_claim = list(dict.fromkeys(t for t in tags if t not in results))
+    waiting = []
+    deadline = time.time() + TAG_WAIT_TIMEOUT
+    while True:
+        claimed_keys = shared_claim([f'lease:tag:{t}' for t in to_claim], TAG_LEASE_TTL)
+        claimed = [t for t in to_claim if f'lease:tag:{t}' in claimed_keys]
+        waiting.extend(t for t in to_claim if t not in claimed)
+        to_claim = []
+
+        if claimed:
+            cacheable = {}
+            try:
+                pi_results, cacheable = read_tags_from_pi(claimed)
+                results.update(pi_results)
+            finally:
+                shared_publish({f'tag:{t}': r for t, r in cacheable.items()}, TAG_CACHE_TTL,
+                               release_keys=[f'lease:tag:{t}' for t in claimed])
+
+        if not waiting or time.time() >= deadline:
+            break
+        time.sleep(0.1)
+
+        # 3. One read per poll for both the cached values and the lease owners
+        entries = shared_get_many([f'tag:{t}' for t in waiting] + [f'lease:tag:{t}' for t in waiting])
+        for tag_name in list(waiting):
+            if f'tag:{tag_name}' in entries:
+                results[tag_name] = entries[f'tag:{tag_name}']
+                waiting.remove(tag_name)
+                continue
+            owner = entries.get(f'lease:tag:{tag_name}')
+            if owner is None or not pid_alive(owner):
+                if owner is not None:
+                    # Left behind by a crashed or recycled worker
+                    shared_release(f'lease:tag:{tag_name}', owner)
+                waiting.remove(tag_name)
+                to_claim.append(tag_name)
+
+    # Another worker is still reading after TAG_WAIT_TIMEOUT; take anything it published
+    # meanwhile, then read the rest ourselves and share them so the next poll hits the cache
+    if waiting:
+        entries = shared_get_many([f'tag:{t}' for t in waiting])
+        for tag_name in list(waiting):
+            if f'tag:{tag_name}' in entries:
+                results[tag_name] = entries[f'tag:{tag_name}']
+                waiting.remove(tag_name)
+    if waiting:
+        pi_results, cacheable = read_tags_from_pi(waiting)
+        results.update(pi_results)
+        shared_publish({f'tag:{t}': r for t, r in cacheable.items()}, TAG_CACHE_TTL)
             
-    return jsonify(results)
+    return jsonify([results[t] for t in tags])
 
 # --- Embedded Frontend ---
 
@@ -410,6 +702,12 @@ try:
 except Exception as e:
     print(f"Database initialization failed: {e}")
 
+try:
+    init_shared_db()
+    shared_prune(force=True)
+except Exception as e:
+    print(f"Shared state initialization failed: {e}")
+
 if __name__ == '__main__':
     # Ensure static folder exists
     if not os.path.exists('static'):
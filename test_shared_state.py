@@ -0,0 +1,244 @@
+"""Cross-worker shared state: tag cache leases, lease expiry/fallback and presence.
+
+Each test runs a copy of app.py in a temp dir next to a fake PIconnect module
+that logs every point read, so the real sops.db / shared_state.db are untouched.
+"""
+import ctypes
+import ctypes.wintypes
+import importlib
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+FAKE_PICONNECT = '''
+import os, time
+READ_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pi_reads.log')
+
+class _Point:
+    def __init__(self, tag):
+        self.tag = tag
+
+    @property
+    def current_value(self):
+        with open(READ_LOG, 'a') as f:
+            f.write(f"{os.getpid()} {self.tag}\\n")
+        time.sleep(0.3)  # make concurrent workers overlap
+        return 42.0
+
+class PIServer:
+    server_name = 'FAKE'
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def search(self, tag):
+        return [_Point(tag)]
+'''
+
+
+def pi_reads(app_dir):
+    path = os.path.join(app_dir, 'pi_reads.log')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [line.split()[1] for line in f if line.strip()]
+
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    return proc.pid
+
+
+@pytest.fixture
+def app_dir(tmp_path):
+    shutil.copy(APP_FILE, tmp_path / 'app.py')
+    (tmp_path / 'PIconnect.py').write_text(FAKE_PICONNECT)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def shared_app(app_dir, monkeypatch):
+    monkeypatch.syspath_prepend(app_dir)
+    for name in ('app', 'PIconnect'):
+        sys.modules.pop(name, None)
+    module = importlib.import_module('app')
+    yield module
+    for name in ('app', 'PIconnect'):
+        sys.modules.pop(name, None)
+
+
+def _worker(app_dir, tag_param, barrier, out_q):
+    sys.path.insert(0, app_dir)
+    import app
+    barrier.wait()
+    with app.app.test_client() as client:
+        out_q.put(client.get(f'/api/get_tag_value?tag={tag_param}').get_json())
+
+
+def test_one_pi_read_per_tag_across_workers(app_dir):
+    workers = 4
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(workers)
+    out_q = ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(app_dir, 'A;B', barrier, out_q)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    responses = [out_q.get(timeout=60) for _ in procs]
+    for p in procs:
+        p.join(timeout=60)
+        assert p.exitcode == 0
+
+    assert sorted(pi_reads(app_dir)) == ['A', 'B']
+    for resp in responses:
+        assert [r['tag'] for r in resp] == ['A', 'B']
+        assert all(r['value'] == 42.0 and r['source'] == 'PI Server' for r in resp)
+    # Every worker returns the payload the reading worker cached
+    assert all(resp == responses[0] for resp in responses)
+
+
+def test_tag_cache_expires_after_ttl(shared_app, app_dir, monkeypatch):
+    monkeypatch.setattr(shared_app, 'TAG_CACHE_TTL', 0.5)
+    client = shared_app.app.test_client()
+
+    client.get('/api/get_tag_value?tag=A')
+    client.get('/api/get_tag_value?tag=A')
+    assert pi_reads(app_dir) == ['A']
+
+    time.sleep(0.6)
+    client.get('/api/get_tag_value?tag=A')
+    assert pi_reads(app_dir) == ['A', 'A']
+
+
+def test_stale_lease_from_dead_worker_is_taken_over(shared_app, app_dir):
+    shared_app.shared_set('lease:tag:Z', dead_pid(), shared_app.TAG_LEASE_TTL)
+    client = shared_app.app.test_client()
+
+    start = time.time()
+    resp = client.get('/api/get_tag_value?tag=Z').get_json()
+    assert time.time() - start < 1.0
+
+    assert resp[0]['value'] == 42.0
+    assert pi_reads(app_dir) == ['Z']
+    assert shared_app.shared_get('tag:Z')['value'] == 42.0
+    assert shared_app.shared_get('lease:tag:Z') is None
+
+
+def test_live_lease_falls_back_after_wait_timeout(shared_app, app_dir, monkeypatch):
+    monkeypatch.setattr(shared_app, 'TAG_WAIT_TIMEOUT', 0.5)
+    holder = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    try:
+        shared_app.shared_set('lease:tag:Y', holder.pid, shared_app.TAG_LEASE_TTL)
+        client = shared_app.app.test_client()
+
+        start = time.time()
+        resp = client.get('/api/get_tag_value?tag=Y').get_json()
+        elapsed = time.time() - start
+
+        assert 0.5 <= elapsed < 2.0
+        assert resp[0]['value'] == 42.0
+        assert pi_reads(app_dir) == ['Y']
+        # The fallback read refills the cache for the other workers
+        assert shared_app.shared_get('tag:Y')['value'] == 42.0
+        # The other worker's lease is left alone
+        assert shared_app.shared_get('lease:tag:Y') == holder.pid
+    finally:
+        holder.kill()
+        holder.wait()
+
+
+def test_waiter_uses_value_published_by_lease_owner(shared_app, app_dir):
+    holder = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    try:
+        shared_app.shared_set('lease:tag:W', holder.pid, shared_app.TAG_LEASE_TTL)
+        published = {'tag': 'W', 'value': 7.0, 'timestamp': 'x', 'source': 'PI Server'}
+        timer = threading.Timer(0.2, shared_app.shared_set, ('tag:W', published, shared_app.TAG_CACHE_TTL))
+        timer.start()
+
+        resp = shared_app.app.test_client().get('/api/get_tag_value?tag=W').get_json()
+        timer.join()
+
+        assert resp == [published]
+        assert pi_reads(app_dir) == []
+    finally:
+        holder.kill()
+        holder.wait()
+
+
+def test_release_keeps_another_workers_lease(shared_app):
+    other = dead_pid()
+    shared_app.shared_set('lease:tag:X', other, shared_app.TAG_LEASE_TTL)
+
+    shared_app.shared_release('lease:tag:X')
+    assert shared_app.shared_get('lease:tag:X') == other
+
+    shared_app.shared_release('lease:tag:X', other)
+    assert shared_app.shared_get('lease:tag:X') is None
+
+
+class _FakeKernel32:
+    """Stands in for kernel32 so the Windows branch of pid_alive runs on any OS."""
+    def __init__(self, handle, last_error=0, wait_result=0x102):
+        self.handle = handle
+        self.last_error = last_error
+        self.wait_result = wait_result
+        self.closed = []
+
+        def open_process(access, inherit, pid):
+            return self.handle
+
+        def wait_for_single_object(handle, ms):
+            return self.wait_result
+
+        def close_handle(handle):
+            self.closed.append(handle)
+
+        self.OpenProcess = open_process
+        self.WaitForSingleObject = wait_for_single_object
+        self.CloseHandle = close_handle
+
+
+@pytest.mark.parametrize('handle, last_error, wait_result, alive', [
+    (None, 87, 0, False),           # ERROR_INVALID_PARAMETER: no such process
+    (None, 5, 0, True),             # ERROR_ACCESS_DENIED: exists under another identity
+    (0x7FFF00001234, 0, 0x102, True),  # 64-bit handle, still running
+    (0x7FFF00001234, 0, 0, False),     # handle signalled: process has exited
+])
+def test_pid_alive_windows(shared_app, monkeypatch, handle, last_error, wait_result, alive):
+    kernel32 = _FakeKernel32(handle, last_error, wait_result)
+    monkeypatch.setattr(shared_app.platform, 'system', lambda: 'Windows')
+    monkeypatch.setattr(ctypes, 'WinDLL', lambda name, use_last_error=False: kernel32, raising=False)
+    monkeypatch.setattr(ctypes, 'get_last_error', lambda: kernel32.last_error, raising=False)
+
+    assert shared_app.pid_alive(os.getpid() + 1) is alive
+    # 64-bit handles must not be truncated to a C int
+    assert kernel32.OpenProcess.restype is ctypes.wintypes.HANDLE
+    assert kernel32.closed == ([handle] if handle else [])
+
+
+def test_presence_count(shared_app, monkeypatch):
+    client = shared_app.app.test_client()
+
+    def beat(process_id, user_id):
+        resp = client.post('/api/heartbeat', json={'process_id': process_id, 'user_id': user_id})
+        return resp.get_json()['online_count']
+
+    assert beat(1, 'alice') == 1
+    assert beat(1, 'bob') == 2
+    assert beat(1, '\U0001F600') == 3
+    assert beat(10, 'alice') == 1
+    assert beat(1, 'alice') == 3
+
+    # An expired heartbeat no longer counts
+    monkeypatch.setattr(shared_app, 'PRESENCE_TTL', -1)
+    beat(2, 'carol')
+    monkeypatch.setattr(shared_app, 'PRESENCE_TTL', 30)
+    assert beat(2, 'dave') == 1